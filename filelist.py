@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
 
@@ -19,11 +19,11 @@ Author: Alper Çakan
 
 import sys
 import os
-from collections import deque
-from datetime import datetime
-import re
-import zipfile
-import hashlib
+import math
+import types
+import threading
+from collections import Counter, defaultdict, deque, namedtuple
+import functools
 
 
 # Command line options
@@ -39,6 +39,200 @@ CMD_OPT_ZIP = '-zip'
 CMD_OPT_NOFILELIST = '-nofilelist'
 CMD_OPT_STATS = '-stats'
 
+# Command line options of each kind
+SELECTOR_OPTS = types.MappingProxyType({
+  CMD_OPT_BEFORE: True, # Option: Does it expect argument?
+  CMD_OPT_AFTER: True,
+  CMD_OPT_MATCH: True,
+  CMD_OPT_BIGGER: True,
+  CMD_OPT_SMALLER: True,
+})
+
+OPERATION_OPTS = types.MappingProxyType({
+  CMD_OPT_DELETE: False,
+  CMD_OPT_ZIP: True
+})
+
+OUTPUT_MODE_OPTS = types.MappingProxyType({
+  CMD_OPT_NOFILELIST: False,
+  CMD_OPT_STATS: False,
+  CMD_OPT_DUPLCONT: False,
+  CMD_OPT_DUPLNAME: False,
+})
+
+# Command line option kinds, i.e., indices in KIND_OPTS
+OPT_KIND_SELECTOR = 0
+OPT_KIND_OPERATION = 1
+OPT_KIND_OUTPUT_MODE = 2
+
+KIND_OPTS = (SELECTOR_OPTS, OPERATION_OPTS, OUTPUT_MODE_OPTS)
+
+# Command line option dispatch table, so that a single lookup tells both the
+# kind of an option and whether it expects an argument
+OPT_KINDS = types.MappingProxyType({
+  opt: (kind, expects_arg) # Option: (Kind, Does it expect argument?)
+  for (kind, kind_opts) in enumerate(KIND_OPTS)
+  for (opt, expects_arg) in kind_opts.items()
+})
+
+# Datetime options, and the lengths of their argument formats. The formats are
+# fixed-width, so the fields are simply sliced out instead of parsing them
+# with the (slow) strptime
+DATETIME_OPTS = (CMD_OPT_BEFORE, CMD_OPT_AFTER)
+DATETIME_LEN = 15 # YYYYMMDDTHHMMSS
+DATETIME_SEPARATOR = 'T'
+DATE_LEN = 8 # YYYYMMDD
+
+# Size options, and their argument suffixes
+SIZE_OPTS = (CMD_OPT_SMALLER, CMD_OPT_BIGGER)
+SIZE_MULTIPLIERS = types.MappingProxyType({
+  'k': 2**10, # kilo
+  'm': 2**20, # mega
+  'g': 2**30, # giga
+})
+
+# Size of the beginning of a file which is fingerprinted first when looking
+# for duplicate contents, before the whole content is
+HEAD_SIZE = 2**16 # 64 KiB
+
+# Extensions of the file formats whose content is already compressed, so that
+# compressing them again is a waste of time
+INCOMPRESSIBLE_EXTS = frozenset({
+  '.jpg', '.jpeg', '.png', '.gif', '.webp', # images
+  '.mp3', '.ogg', '.flac', '.mp4', '.mov', '.mkv', '.webm', # audio and video
+  '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.zst', '.rar', # archives
+  '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', # zip based documents
+})
+
+
+# Types of the network file systems, whose stat calls may wait for a server
+NETWORK_FS_TYPES = frozenset({
+  'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', 'ceph', 'glusterfs',
+  'lustre', '9p',
+})
+
+
+# Linux statx(2) constants, see <linux/fcntl.h> and <linux/stat.h>
+AT_FDCWD = -100
+AT_STATX_DONT_SYNC = 0x4000
+STATX_TYPE = 0x0001
+STATX_MTIME = 0x0040
+STATX_SIZE = 0x0200
+
+
+# the only stats the selection needs; the field names are the same with the
+# ones of os.stat_result so that the two can be used interchangeably
+FastStat = namedtuple('FastStat', ['st_mtime', 'st_size'])
+
+
+@functools.lru_cache(maxsize=None)
+def load_statx():
+  """Loads the statx function of the C library and verifies that it works.
+
+  This is done on the first call only, since it is needed only on network
+  file systems (see network_devices).
+
+  Returns:
+    tuple: The statx function and the class of its struct statx buffer on
+    success, None if it is not available (ex: not on Linux, old C library or
+    old kernel).
+  """
+
+  if not sys.platform.startswith('linux'):
+    return None
+
+  # imported only when needed, since the import slows down the startup
+  import ctypes
+
+  class StatxTimestamp(ctypes.Structure):
+    """The struct statx_timestamp of the Linux statx system call."""
+
+    _fields_ = [
+      ('tv_sec', ctypes.c_int64),
+      ('tv_nsec', ctypes.c_uint32),
+      ('reserved', ctypes.c_int32)
+    ]
+
+  class Statx(ctypes.Structure):
+    """The struct statx of the Linux statx system call."""
+
+    _fields_ = [
+      ('stx_mask', ctypes.c_uint32),
+      ('stx_blksize', ctypes.c_uint32),
+      ('stx_attributes', ctypes.c_uint64),
+      ('stx_nlink', ctypes.c_uint32),
+      ('stx_uid', ctypes.c_uint32),
+      ('stx_gid', ctypes.c_uint32),
+      ('stx_mode', ctypes.c_uint16),
+      ('spare0', ctypes.c_uint16),
+      ('stx_ino', ctypes.c_uint64),
+      ('stx_size', ctypes.c_uint64),
+      ('stx_blocks', ctypes.c_uint64),
+      ('stx_attributes_mask', ctypes.c_uint64),
+      ('stx_atime', StatxTimestamp),
+      ('stx_btime', StatxTimestamp),
+      ('stx_ctime', StatxTimestamp),
+      ('stx_mtime', StatxTimestamp),
+      ('stx_rdev_major', ctypes.c_uint32),
+      ('stx_rdev_minor', ctypes.c_uint32),
+      ('stx_dev_major', ctypes.c_uint32),
+      ('stx_dev_minor', ctypes.c_uint32),
+      ('spare2', ctypes.c_uint64 * 14)
+    ]
+
+  try:
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    statx = libc.statx
+  except (OSError, AttributeError):
+    # no glibc, or a glibc older than 2.28
+    return None
+
+  statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                    ctypes.c_uint, ctypes.POINTER(Statx)]
+  statx.restype = ctypes.c_int
+
+  # the wrapper may exist while the kernel does not support it (ENOSYS), so
+  # probe it once with the root directory
+  buf = Statx()
+  if statx(AT_FDCWD, b'/', AT_STATX_DONT_SYNC, STATX_TYPE, buf) != 0:
+    return None
+
+  return (statx, Statx)
+
+
+@functools.lru_cache(maxsize=None)
+def network_devices():
+  """Finds the devices of the mounted network file systems.
+
+  The mounts are read from /proc/self/mountinfo, so this works on Linux only.
+  The mounts are read on the first call only.
+
+  Returns:
+    frozenset: The device numbers (as in st_dev) of the network (and FUSE)
+    file systems. Empty if the mounts cannot be read.
+  """
+  MOUNT_INFO_PATH = '/proc/self/mountinfo'
+  FS_FIELDS_SEPARATOR = ' - '
+  FUSE_FS_TYPE = 'fuse' # also the prefix of the FUSE subtypes, ex: fuse.sshfs
+
+  devices = set()
+
+  try:
+    with open(MOUNT_INFO_PATH) as mount_info:
+      for line in mount_info:
+        # ex: 36 35 0:52 / /mnt rw - nfs4 server:/export rw,vers=4.2
+        (mount_fields, _, fs_fields) = line.partition(FS_FIELDS_SEPARATOR)
+        fs_type = fs_fields.split(' ', 1)[0]
+
+        if fs_type in NETWORK_FS_TYPES or fs_type.startswith(FUSE_FS_TYPE):
+          (major, minor) = mount_fields.split()[2].split(':')
+          devices.add(os.makedev(int(major), int(minor)))
+  except (OSError, ValueError, IndexError):
+    # not on Linux, or an unexpected format
+    pass
+
+  return frozenset(devices)
+
 
 def parse_args(argv):
   """Parse command line arguments.
@@ -63,61 +257,40 @@ def parse_args(argv):
     respectively.
   """
 
-  SELECTOR_OPTS = {
-    CMD_OPT_BEFORE: True, # Option: Does it expect argument?
-    CMD_OPT_AFTER: True,
-    CMD_OPT_MATCH: True,
-    CMD_OPT_BIGGER: True,
-    CMD_OPT_SMALLER: True,
-  }
-
-  OPERATION_OPTS = {
-    CMD_OPT_DELETE: False,
-    CMD_OPT_ZIP: True
-  }
-
-  OUTPUT_MODE_OPTS = {
-    CMD_OPT_NOFILELIST: False,
-    CMD_OPT_STATS: False,
-    CMD_OPT_DUPLCONT: False,
-    CMD_OPT_DUPLNAME: False,
-  }
-
-  selectors = {}
-  operations = {}
-  output_modes = {}
+  # the options of each kind, indexed by the option kinds. All options are
+  # False by default, set the defaults up front for "key-safety"
+  res_dicts = tuple(dict.fromkeys(kind_opts, False) for kind_opts in KIND_OPTS)
+  (selectors, operations, output_modes) = res_dicts
   paths = []
 
   expect_path = False
+  argv_len = len(argv)
 
   i = 1
-  while  i < len(argv):
+  while  i < argv_len:
     arg = argv[i]
 
     if expect_path:
       paths.append(arg)
     else:
-      if arg in SELECTOR_OPTS:
-        expects_arg = SELECTOR_OPTS[arg]
-        res_dict = selectors
-      elif arg in OPERATION_OPTS:
-        expects_arg = OPERATION_OPTS[arg]
-        res_dict = operations
-      elif arg in OUTPUT_MODE_OPTS:
-        expects_arg = OUTPUT_MODE_OPTS[arg]
-        res_dict = output_modes
-      else:
+      opt_kind = OPT_KINDS.get(arg)
+
+      if opt_kind is None:
         # when we encounter an argument which is not an option, we assume that
         # this and the all of the rest of the arguments are paths.
         expect_path = True
         continue
 
-      if arg in res_dict:
+      (kind, expects_arg) = opt_kind
+      res_dict = res_dicts[kind]
+
+      if res_dict[arg] != False:
+        # supplied twice
         return None
 
       if expects_arg:
-        if i + 1 >= len(argv):
-          return False
+        if i + 1 >= argv_len:
+          return None
 
         res_dict[arg] = argv[i + 1]
 
@@ -130,15 +303,6 @@ def parse_args(argv):
 
     i += 1
 
-  # all options are False by default, set the defaults for "key-safety"
-  for (opt_dict, res_dict) \
-        in zip([SELECTOR_OPTS, OPERATION_OPTS, OUTPUT_MODE_OPTS],
-               [selectors, operations, output_modes]):
-
-    for opt in opt_dict:
-      if not opt in res_dict:
-        res_dict[opt] = False
-
   if output_modes[CMD_OPT_DUPLCONT] and output_modes[CMD_OPT_DUPLNAME]:
     # we do not accept both at the same time
     return None
@@ -162,7 +326,13 @@ def parse_args(argv):
 
 
 def resolve_datetime_selectors(selectors):
-  """Transforms the given datetime selector strings into datetime objects.
+  """Transforms the given datetime selector strings into POSIX timestamps.
+
+  The result of each selector is a (timestamp, has time-of-day) pair, so that
+  the selection can compare the modification times of the files directly,
+  without creating datetime objects for them. When the -before argument does
+  not contain time-of-day, its timestamp is the beginning of the next day,
+  since the whole given day is included.
 
   Args:
     selectors (dict): The dictionary of selectors. Note that this will contain
@@ -174,33 +344,56 @@ def resolve_datetime_selectors(selectors):
     bool: True on success, False on failure.
   """
 
-  DATETIME_FORMAT = '%Y%m%dT%H%M%S' # YYYYMMDDTHHMMSS
-  DATETIME_LEN = 15
-  DATE_FORMAT = '%Y%m%d' # YYYYMMDD
-  DATE_LEN = 8
-
-  DATETIME_OPTS = [
-    CMD_OPT_BEFORE,
-    CMD_OPT_AFTER
-  ]
-
   for opt in DATETIME_OPTS:
     val = selectors[opt]
     if val == False:
       # skip non-existent datetime selectors
       continue
 
+    # imported only when needed, since the import slows down the startup
+    from datetime import datetime, timedelta
+
     # guard against incorrect datetime/date formats
     try:
-      if len(val) == DATETIME_LEN:
-        # this should be datetime
-        val = (datetime.strptime(val, DATETIME_FORMAT), True)
+      if len(val) == DATETIME_LEN and val[DATE_LEN] == DATETIME_SEPARATOR:
+        # this should be datetime
+        digits = val[:DATE_LEN] + val[DATE_LEN + 1:]
+        has_time = True
+      elif len(val) == DATE_LEN:
+        # this should be date only
+        digits = val
+        has_time = False
       else:
-        # this should be date only
-        val = (datetime.strptime(val, DATE_FORMAT), False)
-
-      selectors[opt] = val
-    except ValueError:
+        raise ValueError(val)
+
+      # int accepts signs and spaces, so verify that there are only digits
+      if not (digits.isascii() and digits.isdigit()):
+        raise ValueError(val)
+
+      # datetime verifies the ranges of the fields (ex: no 13th month)
+      limit = datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]))
+
+      if has_time:
+        limit = limit.replace(hour=int(digits[8:10]),
+                              minute=int(digits[10:12]),
+                              second=int(digits[12:14]))
+
+      # the limits at the ends of the datetime range may not be representable
+      # (ex: the day after 9999-12-31, or the year 1 in a timezone behind
+      # UTC), such a limit is clamped to the infinity on its side
+      try:
+        if not has_time and opt == CMD_OPT_BEFORE:
+          limit += timedelta(days=1)
+
+        timestamp = limit.timestamp()
+      except (ValueError, OverflowError):
+        if limit.year == datetime.max.year:
+          timestamp = math.inf
+        else:
+          timestamp = -math.inf
+
+      selectors[opt] = (timestamp, has_time)
+    except (ValueError, OverflowError):
       # format was wrong, remove the selector and return with failure
       selectors[opt] = False
       return False
@@ -209,7 +402,13 @@ def resolve_datetime_selectors(selectors):
 
 
 def resolve_size_selectors(selectors):
-  """Transforms the given size selector strings to float type repr. byte count.
+  """Transforms the given size selector strings to byte counts.
+
+  The sizes of the files are integers, so the limits are rounded inwards to
+  integers (ex: -bigger 0.5 is the same as -bigger 1), and the selection
+  compares integers instead of mixing them with floats. Note that a limit of
+  zero is an integer 0, which equals False, so the size selectors have to be
+  tested against False by identity.
 
   Args:
     selectors (dict): The dictionary of selectors. Note that this will contain
@@ -220,18 +419,6 @@ def resolve_size_selectors(selectors):
     bool: True on success, False on failure.
   """
 
-  SIZE_OPTS = [
-    CMD_OPT_SMALLER,
-    CMD_OPT_BIGGER
-  ]
-
-  MULTIPLIERS = {
-    'k': 2**10, # kilo
-    'm': 2**20, # mega
-    'g': 2**30, # giga
-    '': 1
-  }
-
   for opt in SIZE_OPTS:
     val = selectors[opt]
     if val == False:
@@ -243,17 +430,18 @@ def resolve_size_selectors(selectors):
     if len(val) == 0:
       return False
 
-    suffix = val[-1].lower()
+    multiplier = SIZE_MULTIPLIERS.get(val[-1].lower())
 
-    if suffix in MULTIPLIERS.keys():
+    if multiplier is not None:
       num_lit_str = val[:-1]
     else:
+      # no suffix, plain byte count
       num_lit_str = val
-      suffix = ''
+      multiplier = 1
 
     # guard against non-numbers
     try:
-      selectors[opt] = float(num_lit_str) * MULTIPLIERS[suffix]
+      selectors[opt] = float(num_lit_str) * multiplier
 
       if selectors[opt] < 0:
         # negative not allowed
@@ -262,9 +450,43 @@ def resolve_size_selectors(selectors):
       # the size option argument was not a number
       return False
 
+    # infinite (or not a number) limits cannot be integers, they stay as they
+    # are
+    if math.isfinite(selectors[opt]):
+      if opt == CMD_OPT_BIGGER:
+        selectors[opt] = math.ceil(selectors[opt])
+      else:
+        selectors[opt] = math.floor(selectors[opt])
+
   return True
 
 
+@functools.lru_cache(maxsize=64)
+def compile_match_pattern(pattern):
+  """Compiles the pattern of the match selector.
+
+  The compiled patterns are cached, so that compiling the same pattern again
+  (ex: when this module is used from scripts or tests) is free.
+
+  Args:
+    pattern (str): The pattern.
+
+  Returns:
+    The compiled pattern, which has the fullmatch method.
+
+  Raises:
+    re.error: If the pattern is illegal.
+
+    OverflowError, RecursionError: If the pattern is too big for the compiler
+    (ex: a huge repeat count like "a{99999999999}", or deeply nested groups).
+  """
+
+  # imported only when needed, since the import slows down the startup
+  import re
+
+  return re.compile(pattern)
+
+
 def resolve_match_selector(selectors):
   """Transforms the given match selector strings to a compiled regex object.
 
@@ -278,18 +500,19 @@ def resolve_match_selector(selectors):
   """
 
   if selectors[CMD_OPT_MATCH] != False:
+    # imported only when needed, since the import slows down the startup
+    import re
+
     # guard against illegal regexes
     try:
-      re.compile(selectors[CMD_OPT_MATCH])
-    except:
+      # the pattern is used with fullmatch, so that it has to match the whole
+      # name (ex: pattern "a" does not match "abc")
+      selectors[CMD_OPT_MATCH] = \
+        compile_match_pattern(selectors[CMD_OPT_MATCH])
+    except (re.error, OverflowError, RecursionError):
+      # see compile_match_pattern for the errors other than re.error
       return False
 
-    # we wrap the given pattern and add \Z to it so that the final pattern
-    # becomes a only-full-match pattern (ex: pattern "a" does not match "abc")
-    # because unlike Pyton 3, we do not have the method "fullmatch" in Python 2
-    selectors[CMD_OPT_MATCH] = \
-      re.compile('({})\Z'.format(selectors[CMD_OPT_MATCH]))
-
   return True
 
 
@@ -320,220 +543,813 @@ def resolve_paths(paths):
   return True
 
 
-def select(file_path, selectors):
-  """Tests if a file is "selected" by the given selectors.
+def fast_stat(file_path):
+  """Obtains the stats of a file which the selection needs, using statx.
+
+  Unlike os.stat, this fetches only the size and the modification time, and
+  it does not force a synchronization with the server on network file
+  systems. Symbolic links are followed, just like os.stat does. This must be
+  used only if load_statx does not return None.
 
   Args:
-    file_path (str): The absolute path of the file.
+    file_path (str): Path of the file.
+
+  Returns:
+    FastStat or os.stat_result: The stats of the file. The latter is returned
+    if the file system could not provide the size or the modification time
+    through statx.
+
+  Raises:
+    OSError: If the statx call (or the os.stat call) fails.
+  """
+  STATX_FIELDS = STATX_MTIME | STATX_SIZE
+
+  (statx, Statx) = load_statx()
+  buf = Statx()
+
+  if statx(AT_FDCWD, os.fsencode(file_path), AT_STATX_DONT_SYNC,
+           STATX_FIELDS, buf) != 0:
+    # already imported by load_statx
+    import ctypes
+
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), file_path)
+
+  if (buf.stx_mask & STATX_FIELDS) != STATX_FIELDS:
+    # the file system is allowed to leave out the requested fields it does
+    # not have, and the buffer holds zeros for them then
+    return os.stat(file_path)
+
+  mtime = buf.stx_mtime.tv_sec + buf.stx_mtime.tv_nsec * 1e-9
 
+  return FastStat(mtime, buf.stx_size)
+
+
+def select_func(selectors):
+  """Builds the function which tests if a file is "selected" by the given
+  selectors.
+
+  The source of the function is generated so that it contains only the tests
+  of the selectors which are actually given, and the unused ones cost nothing
+  per file. The functions are cached by the selector values, so that each
+  distinct set of selectors is compiled only once.
+
+  Args:
     selectors (dict): The dictionary of the usual, supported selectors.
 
   Returns:
-    bool: True if the file is selected, False otherwise.
+    function: The function which takes the directory entry (os.DirEntry) and
+    the stats (os.stat_result or FastStat) of a file, and returns True if the
+    file is selected, False otherwise.
   """
 
-  file_name = os.path.basename(file_path)
-  file_stats = os.stat(file_path)
-  modif_datetime = datetime.fromtimestamp(file_stats.st_mtime)
+  return compile_select_func(selectors[CMD_OPT_MATCH],
+                             selectors[CMD_OPT_BEFORE],
+                             selectors[CMD_OPT_AFTER],
+                             selectors[CMD_OPT_SMALLER],
+                             selectors[CMD_OPT_BIGGER])
 
-  # date only version the modification datetime
-  modif_date = modif_datetime.replace(hour = 0, minute = 0, second = 0,
-                                      microsecond = 0)
 
-  if selectors[CMD_OPT_MATCH] != False and \
-     not selectors[CMD_OPT_MATCH].match(file_name):
-    # name did not match
-    return False
+# typed, since a size limit of 0 must not be mistaken for an unused (False) one
+@functools.lru_cache(maxsize=16, typed=True)
+def compile_select_func(match, before, after, smaller, bigger):
+  """Generates and compiles the selection function of select_func.
+
+  Args:
+    match, before, after, smaller, bigger: The resolved values of the
+    corresponding selectors, False for the unused ones.
+
+  Returns:
+    function: See select_func.
+  """
+
+  namespace = {}
+  tests = []
 
-  if selectors[CMD_OPT_BEFORE] != False:
-    lower_lim = selectors[CMD_OPT_BEFORE][0]
+  if match != False:
+    namespace['fullmatch'] = match.fullmatch
+    tests.append('fullmatch(entry.name) is not None')
 
-    if selectors[CMD_OPT_BEFORE][1]:
-      modif_val = modif_datetime
+  if before != False:
+    (namespace['upper_lim'], has_time) = before
+
+    if has_time:
+      tests.append('file_stats.st_mtime <= upper_lim')
     else:
-      # option argument does not contain time-of-day
-      modif_val = modif_date
+      # option argument does not contain time-of-day, so the limit is the
+      # beginning of the next day
+      tests.append('file_stats.st_mtime < upper_lim')
 
-    if not lower_lim >= modif_val:
-      return False
+  if after != False:
+    # with or without time-of-day, the limit itself is the earliest time
+    namespace['lower_lim'] = after[0]
+    tests.append('lower_lim <= file_stats.st_mtime')
+
+  if smaller is not False:
+    namespace['max_size'] = smaller
+    tests.append('file_stats.st_size <= max_size')
+
+  if bigger is not False:
+    namespace['min_size'] = bigger
+    tests.append('min_size <= file_stats.st_size')
+
+  src = 'def select(entry, file_stats):\n' \
+        '  return ' + (' and '.join(tests) if tests else 'True') + '\n'
+
+  exec(src, namespace)
+
+  return namespace['select']
+
+
+def select_files(entries, files_stats, selectors):
+  """Tests which of the given files are "selected" by the given selectors.
+
+  Args:
+    entries (list): The directory entries (os.DirEntry) of the files.
+
+    files_stats (list): The stats of the files, in the same order.
+
+    selectors (dict): The dictionary of the usual, supported selectors.
+
+  Returns:
+    list: The results (bool) of the files, in the same order.
+  """
+
+  select = select_func(selectors)
+
+  return [select(entry, file_stats)
+          for entry, file_stats in zip(entries, files_stats)]
+
+
+def scan_dir(cur_dir, enqueue, lock, visited_dirs, selected, stats,
+             selectors, output_modes, out):
+  """Scans the entries of a single directory during the traversal.
+
+  The subdirectories are put into the work queue, and the files are tested
+  and recorded. This may be run by multiple threads at the same time, so all
+  of the shared objects (except the queue, which must be thread-safe then)
+  are only touched while holding the given lock.
+
+  Args:
+    cur_dir (str): The absolute path of the directory to be scanned.
 
-  if selectors[CMD_OPT_AFTER] != False:
-    upper_lim = selectors[CMD_OPT_AFTER][0]
+    enqueue (function): The function which puts a directory into the work
+    queue of the directories to be scanned.
 
-    if selectors[CMD_OPT_AFTER][1]:
-      modif_val = modif_datetime
+    lock (threading.Lock): The lock which guards the shared objects.
+
+    visited_dirs, selected, stats, selectors, output_modes, out: See
+    traverse.
+
+  Returns:
+    None.
+  """
+
+  dir_stats = os.stat(cur_dir)
+  dir_key = (dir_stats.st_dev, dir_stats.st_ino)
+
+  with lock:
+    if dir_key in visited_dirs:
+      # we have already seen this directory (ex: through a link)
+      return
+
+    visited_dirs.add(dir_key)
+
+  files = []
+
+  # the methods used per entry are bound once, to skip the attribute lookups
+  add_file = files.append
+  realpath = os.path.realpath
+
+  # scandir gives us the file types (and caches the stats) along with the
+  # names, which saves us from a bunch of stat calls per entry
+  with os.scandir(cur_dir) as dir_cont:
+    for entry in dir_cont:
+      # the directories are checked against visited_dirs only when they are
+      # scanned, so that there is a single stat call per directory
+      if entry.is_dir(follow_symlinks=False):
+        enqueue(entry.path)
+      elif entry.is_symlink() and entry.is_dir():
+        enqueue(realpath(entry.path)) # eliminate symbolic links
+      elif entry.is_file():
+        # the files are handled all together below
+        add_file(entry)
+
+  # the stat calls are the expensive part, so they are avoided whenever the
+  # stats are not needed: the names are tested first (unless every visited
+  # file has to be counted for -stats), and the stats of the files whose
+  # names matched are fetched only if a size/time selector or -duplcont
+  # needs them
+  track_sizes = output_modes[CMD_OPT_STATS]
+  needs_stat = track_sizes or output_modes[CMD_OPT_DUPLCONT] or \
+               selectors[CMD_OPT_BEFORE] != False or \
+               selectors[CMD_OPT_AFTER] != False or \
+               selectors[CMD_OPT_SMALLER] is not False or \
+               selectors[CMD_OPT_BIGGER] is not False
+
+  visit_count = len(files)
+  file_selectors = selectors
+
+  if not track_sizes and selectors[CMD_OPT_MATCH] != False:
+    fullmatch = selectors[CMD_OPT_MATCH].fullmatch
+    files = [entry for entry in files if fullmatch(entry.name)]
+
+    # the names are already tested
+    file_selectors = dict(selectors)
+    file_selectors[CMD_OPT_MATCH] = False
+
+  if needs_stat:
+    # the stat calls are done without the lock, so that the threads can wait
+    # for the disk at the same time
+    if dir_stats.st_dev in network_devices() and load_statx() is not None:
+      # statx skips the synchronization with the server, which is worth its
+      # overhead only on network file systems
+      files_stats = [fast_stat(entry.path) for entry in files]
     else:
-      # option argument does not contain time-of-day
-      modif_val = modif_date
+      files_stats = [entry.stat() for entry in files] # cached by the entries
 
-    if not upper_lim <= modif_val:
-      return False
+    selections = select_files(files, files_stats, file_selectors)
+  else:
+    files_stats = [None] * len(files)
+    selections = [True] * len(files)
 
-  if selectors[CMD_OPT_SMALLER] != False and \
-     not selectors[CMD_OPT_SMALLER] >= file_stats.st_size:
-    # size too big
-    return False
+  # the statistics and the results are collected in locals first, and the
+  # shared objects are updated all at once, so that the lock is taken once
+  # per directory and the dictionary lookups are not done per file. The
+  # sums are done by the builtin sum, instead of adding up one by one
+  nofilelist = output_modes[CMD_OPT_NOFILELIST]
+  visit_size = 0
+  list_count = 0
+  list_size = 0
 
-  if selectors[CMD_OPT_BIGGER] != False and \
-     not selectors[CMD_OPT_BIGGER] <= file_stats.st_size:
-    # size too small
-    return False
+  dir_selected = [(entry.path, file_stats)
+                  for entry, file_stats, is_selected
+                  in zip(files, files_stats, selections) if is_selected]
 
-  # yay, passed!
-  return True
+  if not nofilelist:
+    list_count = len(dir_selected)
+
+  if track_sizes:
+    visit_size = sum([file_stats.st_size for file_stats in files_stats])
+
+    if not nofilelist:
+      list_size = sum([file_stats.st_size
+                       for (cur_item, file_stats) in dir_selected])
+
+  with lock:
+    stats['visit_count'] += visit_count
+    stats['visit_size'] += visit_size
+    stats['list_count'] += list_count
+    stats['list_size'] += list_size
+
+    selected.update(dir_selected)
+
+    if not nofilelist:
+      out.write_lines([cur_item for (cur_item, file_stats) in dir_selected])
 
 
-def traverse(path, visit_table, selected, stats, selectors, output_modes):
-  """Traverses the file system in breadth-first manner.
+def traverse(path, visited_dirs, selected, stats, selectors, output_modes,
+             out):
+  """Traverses the file system breadth-first.
+
+  The directories on network file systems are scanned by a pool of worker
+  threads instead (see traverse_parallel), since most of the time is spent
+  waiting for the server there. Note that the files are printed in the order
+  they are found then, which is roughly (but not strictly) breadth-first and
+  may differ between runs.
 
   Args:
     path (str): The absolute path of the traversal root.
 
-    visit_table (dict): A dictionary which marks which files and directories
-    has already been seen. This will modified during the traversal.
+    visited_dirs (set): The directories which has already been scanned, as
+    (st_dev, st_ino) pairs, so that the directories reached through
+    symbolic links (or through multiple roots) are not scanned twice. This
+    will modified during the traversal.
 
-    selected (set): The set of "selected" files according to the given
-    selectors.
+    selected (dict): The "selected" files according to the given selectors,
+    as a dictionary from their paths to their stats (os.stat_result or
+    FastStat). The stats are None when nothing needs them (i.e., no size or
+    time selector, no -stats and no -duplcont). This will be modified.
 
     stats (dict): The traversal statistics. This will be modified. Also,
     this is not reset here. So, if you have any prior statistics in it,
-    the new statistics will be build upon on that.
+    the new statistics will be build upon on that. Note that the sizes are
+    only collected if CMD_OPT_STATS is given in output_modes.
 
     selectors (dict): The selectors which are to be used for selecting which
     files should be selected (and printed if the output mode allows).
 
     output_modes (dict): The output modes which dictates whether the selected
-    files should be printed or not. Note that only option this method cares
-    about is CMD_OPT_NOFILELIST.
+    files should be printed or not (CMD_OPT_NOFILELIST). CMD_OPT_STATS and
+    CMD_OPT_DUPLCONT are also checked, to tell whether the stats of the files
+    are needed at all.
+
+    out (OutputBuffer): The buffer which the selected files are printed to.
 
   Returns:
     None.
   """
 
-  q = deque([path])
+  if os.stat(path).st_dev in network_devices():
+    traverse_parallel(path, visited_dirs, selected, stats, selectors,
+                      output_modes, out)
+    return
 
-  # although the name may suggest otherwise, the value here is not important
-  # all existing keys are visited, and the value True/False just implies
-  # whether it is a file or a directory, respectively
-  visit_table[path] = True # root is visited and is a dir
+  # there is no other thread, so the lock is never contended
+  lock = threading.Lock()
+  q = deque([path])
 
   # BFS
   while q:
-    cur_dir = q.popleft() # deque
-    dir_cont = os.listdir(cur_dir)
+    scan_dir(q.popleft(), q.append, lock, visited_dirs, selected, stats,
+             selectors, output_modes, out)
 
-    for name in dir_cont:
-      cur_item = os.path.join(cur_dir, name)
 
-      if cur_item in visit_table:
-        continue
+def traverse_parallel(path, visited_dirs, selected, stats, selectors,
+                      output_modes, out):
+  """Traverses the file system using multiple threads.
+
+  The directories are scanned by a pool of worker threads (one per CPU)
+  which share a work queue, so that the directory reads and the stat calls
+  of different directories can wait for the server at the same time. This
+  pays off only when the calls wait for a long time (ex: on network file
+  systems), since the threads compete for the GIL otherwise.
+
+  Args:
+    path, visited_dirs, selected, stats, selectors, output_modes, out: See
+    traverse.
+
+  Returns:
+    None.
+
+  Raises:
+    Exception: The first exception raised while scanning a directory, after
+    all of the workers are stopped.
+  """
+
+  WORKER_COUNT = os.cpu_count() or 1
+
+  # imported only when needed, since the import slows down the startup
+  import queue
+
+  q = queue.Queue()
+  lock = threading.Lock()
+  errors = []
+
+  def worker():
+    """Scans the directories in the queue until a None is received."""
+    while True:
+      cur_dir = q.get()
 
-      if os.path.isdir(cur_item):
-        if os.path.islink(cur_item):
-          cur_item = os.path.realpath(cur_item) # eliminate symbolic links
+      if cur_dir is None:
+        q.task_done()
+        return
 
-        q.append(cur_item) # enqueue
+      try:
+        if not errors:
+          scan_dir(cur_dir, q.put, lock, visited_dirs, selected, stats,
+                   selectors, output_modes, out)
+      except Exception as e:
+        # stop the traversal, the error is re-raised from the caller thread
+        errors.append(e)
+      finally:
+        q.task_done()
 
-        # mark visited and file/dir type
-        visit_table[cur_item] = True # a directory
-      elif os.path.isfile(cur_item):
-        file_size = os.path.getsize(cur_item)
+  q.put(path)
 
-        # being visited does not
-        stats['visit_count'] += 1
-        stats['visit_size'] += file_size
+  workers = [threading.Thread(target=worker) for i in range(WORKER_COUNT)]
 
-        # mark visited and file/dir type
-        visit_table[cur_item] = False # not a directory
+  for thread in workers:
+    thread.start()
 
-        if select(cur_item, selectors):
-          selected.add(cur_item)
+  # wait until all of the directories are scanned, then stop the workers
+  q.join()
 
-          if not output_modes[CMD_OPT_NOFILELIST]:
-            stats['list_count'] += 1
-            stats['list_size'] += file_size
-            print(cur_item)
+  for thread in workers:
+    q.put(None)
 
+  for thread in workers:
+    thread.join()
 
-def file_shasum(file_path):
-  """Calculates the SHA1 hash of the content of a file.
+  if errors:
+    raise errors[0]
+
+
+@functools.lru_cache(maxsize=None)
+def has_sha_extensions():
+  """Tells if the CPU has the instructions which compute SHA-256.
+
+  The flags of the CPU are read from /proc/cpuinfo, which lists them as
+  "sha_ni" on x86 and as "sha2" on ARM. The answer is False when the flags
+  cannot be read (ex: on other operating systems).
+
+  Returns:
+    bool: True if the CPU has the SHA extensions, False otherwise.
+  """
+  CPU_INFO_PATH = '/proc/cpuinfo'
+  FLAG_LINE_PREFIXES = ('flags', 'Features')
+  SHA_FLAGS = ('sha_ni', 'sha2')
+
+  try:
+    with open(CPU_INFO_PATH) as cpu_info:
+      for line in cpu_info:
+        if line.startswith(FLAG_LINE_PREFIXES):
+          # all of the cores have the same flags, the first one is enough
+          flags = line.split()
+          return any(flag in flags for flag in SHA_FLAGS)
+  except OSError:
+    pass
+
+  return False
+
+
+@functools.lru_cache(maxsize=None)
+def load_blake3():
+  """Imports the optional blake3 module, which is a much faster hash.
+
+  This is done on the first call only, since only -duplcont needs it.
+
+  Returns:
+    The blake3 module, None if it is not installed.
+  """
+
+  try:
+    import blake3
+  except ImportError:
+    return None
+
+  return blake3
+
+
+def new_hasher(data_size):
+  """Creates a hasher for fingerprinting file contents.
+
+  BLAKE3 is used if it is installed. Otherwise, SHA-256 of the standard
+  library is used if the CPU computes it with the SHA extensions (which makes
+  it about twice as fast as BLAKE2b), and BLAKE2b is used if not. The choice
+  depends only on the machine, so all of the fingerprints of a run are
+  comparable. All of them are more than enough for telling duplicate contents
+  apart.
+
+  Args:
+    data_size (int): The number of bytes which is going to be hashed. Big
+    inputs are hashed by multiple threads when BLAKE3 is used.
+
+  Returns:
+    The hasher object, with the usual update and digest methods.
+  """
+  BLAKE3_MULTITHREAD_THRESHOLD = 2**23 # 8 MiB
+  BLAKE2_DIGEST_SIZE = 16
+
+  blake3 = load_blake3()
+
+  if blake3 is None:
+    # imported only when needed, since the import slows down the startup
+    import hashlib
+
+    if has_sha_extensions():
+      return hashlib.sha256()
+
+    return hashlib.blake2b(digest_size=BLAKE2_DIGEST_SIZE)
+
+  if data_size > BLAKE3_MULTITHREAD_THRESHOLD:
+    return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+  return blake3.blake3()
+
+
+# the read buffers of the hashing threads, which are reused for every file
+# (one per thread, since the files are hashed by multiple threads at once)
+READ_BUFFERS = threading.local()
+
+
+def file_fingerprint(file_path, file_size):
+  """Calculates the fingerprint (hash) of the content of a file.
+
+  Small files are read without Python's buffering, straight into a 1 MiB
+  buffer which is reused by the calling thread, so that a small file takes a
+  single read call and no allocation. Big files are memory mapped so that
+  the hasher can digest them without copying them chunk by chunk.
+
+  Note that comparing the fingerprints is probabilistic: two different
+  contents could have the same fingerprint in theory, but the chance of that
+  is negligible.
+
+  Args:
+    file_path (str): Path of the file.
+
+    file_size (int): Size of the file, as found by the traversal.
+
+  Returns:
+    The fingerprint of the content (bytes).
+  """
+  READ_BUFFER_SIZE = 2**20 # 1 MiB
+  MMAP_THRESHOLD = READ_BUFFER_SIZE
+
+  hasher = new_hasher(file_size)
+
+  if file_size == 0:
+    # empty files cannot be memory mapped, and there is nothing to read anyway
+    return hasher.digest()
+
+  with open(file_path, 'rb', buffering=0) as file:
+    if file_size >= MMAP_THRESHOLD:
+      # imported only when needed, since the import slows down the startup
+      import mmap
+
+      with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        hasher.update(mapped)
+        return hasher.digest()
+
+    buf = getattr(READ_BUFFERS, 'buf', None)
+
+    if buf is None:
+      # first file of this thread
+      buf = READ_BUFFERS.buf = memoryview(bytearray(READ_BUFFER_SIZE))
+
+    # the loop is for the files which have grown since their stat call
+    read_size = file.readinto(buf)
+
+    while read_size:
+      hasher.update(buf[:read_size])
+      read_size = file.readinto(buf)
+
+    return hasher.digest()
+
+
+def file_head_fingerprint(file_path, file_size):
+  """Calculates the fingerprint (hash) of the beginning of a file.
 
   Args:
     file_path (str): Path of the file.
 
+    file_size (int): Size of the file, as found by the traversal.
+
+  Returns:
+    The fingerprint of the first HEAD_SIZE bytes of the content (bytes).
+  """
+
+  # the size is known, so that the small files are not read once more just to
+  # hit the end of the file
+  expected_size = min(file_size, HEAD_SIZE)
+
+  hasher = new_hasher(expected_size)
+  buf = memoryview(bytearray(expected_size))
+  head_size = 0
+
+  with open(file_path, 'rb', buffering=0) as file:
+    # an unbuffered read may return less than asked for before the end of the
+    # file (ex: on network file systems), so read until the head is complete
+    while head_size < expected_size:
+      read_size = file.readinto(buf[head_size:])
+
+      if not read_size:
+        # end of the file
+        break
+
+      head_size += read_size
+
+  hasher.update(buf[:head_size])
+
+  return hasher.digest()
+
+
+def refine_buckets(buckets, key_func, selected, executor):
+  """Splits the duplication buckets further according to a finer criterion.
+
+  Buckets with a single item are carried over as they are, since splitting
+  them cannot reveal anything and key_func may be expensive. The finer keys
+  are computed by the given pool of threads, since key_func is expected to
+  be I/O bound (ex: hashing, where the GIL is released while reading and
+  hashing).
+
+  Args:
+    buckets (dict): The buckets as a dictionary from the current "duplication
+    criterion" to the list of the paths in that bucket.
+
+    key_func (function): The function which gives the finer criterion of a
+    path, given the path and the size of the file.
+
+    selected (dict): The selected files as a dictionary from their paths to
+    their stats, which give the sizes for key_func without any more stat
+    calls.
+
+    executor (concurrent.futures.ThreadPoolExecutor): The pool of threads
+    which runs key_func.
+
   Returns:
-    The SHA1 hash.
+    dict: The refined buckets, keyed by (old key, finer key) pairs.
+  """
+
+  candidates = [item for bucket in buckets.values() if len(bucket) > 1
+                for item in bucket]
+
+  sizes = [selected[item].st_size for item in candidates]
+
+  finer_keys = dict(zip(candidates, executor.map(key_func, candidates, sizes)))
+
+  refined = {}
+
+  for bucket_key, bucket in buckets.items():
+    if len(bucket) == 1:
+      refined[bucket_key] = bucket
+      continue
+
+    for item in bucket:
+      refined_key = (bucket_key, finer_keys[item])
+
+      if not refined_key in refined:
+        # create the bucket
+        refined[refined_key] = []
+
+      refined[refined_key].append(item)
+
+  return refined
+
+
+class OutputBuffer(object):
+  """Buffers the lines which are written to the standard output.
+
+  Printing every line separately is costly when there are a lot of lines
+  (ex: listing a huge tree), so the lines are collected as bytes and written
+  in big chunks instead. This is meant to be used as a context manager, so
+  that whatever is left is written on exit. Note that everything written to
+  the standard output must go through the buffer, which bypasses the text
+  layer of sys.stdout.
   """
-  CHUNKSIZE = 32768
-  sha1 = hashlib.sha1()
-  file = open(file_path, 'rb')
 
-  while True:
-    data = file.read(CHUNKSIZE)
+  FLUSH_SIZE = 2**16 # 64 KiB
+
+  def __init__(self):
+    self.buf = bytearray()
+
+    # the lines are mostly paths, so they are encoded just like the file
+    # system does, so that undecodable names are written back as they are
+    self.encoding = sys.getfilesystemencoding()
+    self.errors = sys.getfilesystemencodeerrors()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.flush()
+    return False
+
+  def write_line(self, line):
+    """Writes a line (without the line break) to the buffer.
+
+    Args:
+      line (str): The line.
+
+    Returns:
+      None.
+    """
+
+    self.write_lines((line,))
+
+  def write_lines(self, lines):
+    """Writes multiple lines (without the line breaks) to the buffer.
+
+    The lines are joined and encoded all at once, which is much cheaper than
+    writing them one by one.
+
+    Args:
+      lines (list): The lines.
+
+    Returns:
+      None.
+    """
+
+    if not lines:
+      return
+
+    self.buf += '\n'.join(lines).encode(self.encoding, self.errors)
+    self.buf += b'\n'
+
+    if len(self.buf) >= self.FLUSH_SIZE:
+      self.flush()
+
+  def flush(self):
+    """Writes the buffered lines to the standard output.
 
-    if not data:
-      break
+    Returns:
+      None.
+    """
 
-    sha1.update(data)
+    if not self.buf:
+      return
 
-  file.close()
-  return sha1.hexdigest()
+    sys.stdout.buffer.write(self.buf)
+    sys.stdout.buffer.flush()
+    self.buf.clear()
 
 
-def print_dupl(selected, duplname, stats):
+def print_dupl(selected, duplname, stats, out):
   """Prints the duplicate files.
 
   Args:
-    selected (set): The set of selected files to be written.
+    selected (dict): The selected files to be written, as a dictionary from
+    their paths to their stats.
 
     duplname (bool): If True, the duplication grouping will be done by the
-    file names. If not, it will be done by file contents.
+    file names. If not, it will be done by file contents. The contents are
+    never kept in memory or compared byte by byte; the files are compared by
+    their sizes and then by their fingerprints, so the comparison is
+    probabilistic (see file_fingerprint).
 
     stats (dict): The usual statistics object. Will be updated.
 
+    out (OutputBuffer): The buffer which the duplicates are printed to.
+
   Returns:
     None.
   """
 
   DUPL_BUCKET_SEPARATOR = '------'
 
+  # the hashing threads mostly wait for the disk, so there are more of them
+  # than the CPUs
+  HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
   # for grouping the duplicates, we put them in buckets
   # since the dictionary types is very efficent, we can use it for this aim
   # by making the "duplication criterion" the key and use lists as the values
-  buckets = {}
+  buckets = defaultdict(list)
 
   for visited_item in selected:
     # choose the key according to the "duplication criterion"
     if duplname:
-      bucket_key = os.path.basename(visited_item)
+      # the paths are built by scandir as "directory + separator + name", so
+      # the name is simply what comes after the last separator. The names are
+      # interned, since they repeat a lot (ex: README.md) and the interned
+      # ones are compared by identity in the bucket lookups
+      bucket_key = sys.intern(visited_item.rpartition(os.sep)[2])
     else:
-      bucket_key = file_shasum(visited_item)
-
-    if not bucket_key in buckets:
-      # create the bucket
-      buckets[bucket_key] = []
+      # files of different sizes cannot have the same content, so the size is
+      # the first (and the cheapest) content criterion
+      bucket_key = selected[visited_item].st_size
 
     buckets[bucket_key].append(visited_item)
 
-  for name, bucket in buckets.iteritems():
+  if not duplname:
+    # imported only when needed, since the import slows down the startup
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the same threads serve both of the passes
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+      # only the files which still have company are worth reading: first the
+      # heads are compared, and the full contents only if the heads agree
+      buckets = refine_buckets(buckets, file_head_fingerprint, selected,
+                               executor)
+
+      # the head of a file which is not bigger than HEAD_SIZE is its whole
+      # content, so its head fingerprint is already the full one and the file
+      # is not hashed again
+      final_buckets = {}
+      big_buckets = {}
+
+      for bucket_key, bucket in buckets.items():
+        if selected[bucket[0]].st_size <= HEAD_SIZE:
+          final_buckets[bucket_key] = bucket
+        else:
+          big_buckets[bucket_key] = bucket
+
+      final_buckets.update(refine_buckets(big_buckets, file_fingerprint,
+                                          selected, executor))
+      buckets = final_buckets
+
+  for bucket in buckets.values():
     # print sorted
     bucket.sort()
 
+  # the buckets themselves are ordered too, instead of sorting all of the
+  # selected files up front
+  if duplname:
+    ordered_buckets = [buckets[name] for name in sorted(buckets)]
+  else:
+    # the content keys (sizes and fingerprints) have no meaningful order, so
+    # the buckets are ordered by their first paths
+    ordered_buckets = sorted(buckets.values(), key=lambda bucket: bucket[0])
+
+  for bucket in ordered_buckets:
     for path in bucket:
       stats['list_count'] += 1
-      stats['list_size'] += os.path.getsize(path)
 
-      print(path)
+      if selected[path] is not None:
+        stats['list_size'] += selected[path].st_size
 
-    print(DUPL_BUCKET_SEPARATOR)
+    out.write_lines(bucket)
+    out.write_line(DUPL_BUCKET_SEPARATOR)
 
 
-def print_stats(stats):
+def print_stats(stats, out):
   """Prints the usual statistics object in a beatiful way.
 
   Args:
     stats (dict): The usual statistics object.
 
+    out (OutputBuffer): The buffer which the statistics are printed to.
+
   Returns:
     None.
   """
@@ -542,24 +1358,64 @@ def print_stats(stats):
   STAT_MSG_LIST_COUNT = 'Total number of files listed: {}'
   STAT_MSG_LIST_SIZE = 'Total size of files listed: {} bytes'
 
-  print('')
-  print(STAT_MSG_VISIT_COUNT.format(stats['visit_count']))
-  print(STAT_MSG_VISIT_SIZE.format(stats['visit_size']))
-  print(STAT_MSG_LIST_COUNT.format(stats['list_count']))
-  print(STAT_MSG_LIST_SIZE.format(stats['list_size']))
+  out.write_lines([
+    '',
+    STAT_MSG_VISIT_COUNT.format(stats['visit_count']),
+    STAT_MSG_VISIT_SIZE.format(stats['visit_size']),
+    STAT_MSG_LIST_COUNT.format(stats['list_count']),
+    STAT_MSG_LIST_SIZE.format(stats['list_size'])
+  ])
 
 
 def delete_files(files):
   """Deletes the files whose paths are given.
 
+  The files are deleted one by one, so that the deletion stops at the first
+  failure and the rest of the files are left untouched.
+
   Args:
     file (list): The paths of the files to be deleted
 
   Returns:
     None.
   """
+  unlink = os.unlink
+
   for file in files:
-    os.remove(file)
+    unlink(file)
+
+
+def is_compressed(file_path):
+  """Tells if the content of a file is already compressed.
+
+  The well-known extensions (see INCOMPRESSIBLE_EXTS) are trusted without
+  opening the file, and the other files are told by their headers.
+
+  Args:
+    file_path (str): Path of the file.
+
+  Returns:
+    bool: True if the file starts with the magic number of a compressed
+    format (ex: JPEG, ZIP, GZIP, MP4), False otherwise.
+  """
+  HEADER_SIZE = 16
+  MAGIC_NUMBERS = (
+    b'\xff\xd8', # JPEG
+    b'PK\x03\x04', # ZIP (and the formats based on it, ex: docx, jar)
+    b'\x1f\x8b', # GZIP
+    b'\x89PNG', # PNG
+  )
+  MP4_MAGIC = b'ftyp' # MP4 (and MOV), after the 4 byte box size
+  MP4_MAGIC_OFFSET = 4
+
+  if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTS:
+    return True
+
+  with open(file_path, 'rb') as file:
+    header = file.read(HEADER_SIZE)
+
+  return header.startswith(MAGIC_NUMBERS) or \
+         header[MP4_MAGIC_OFFSET:].startswith(MP4_MAGIC)
 
 
 def zip_files(files, zip_path):
@@ -568,7 +1424,9 @@ def zip_files(files, zip_path):
   The files are zipped so that all of them will be in the archive root
   regardless of their current full path. Also, the name collisions will
   be resolved by adding a number inside paranthesis to the beginning of
-  the names of the files.
+  the names of the files. The files are compressed with a fast DEFLATE
+  level, except the ones whose content is already compressed, which are
+  just stored since compressing them again would only waste time.
 
   Args:
     files (list): The paths of the files to be zipped
@@ -582,25 +1440,38 @@ def zip_files(files, zip_path):
     # we do not want to override
     return False
 
-  zip_file = zipfile.ZipFile(zip_path, 'w')
+  # imported only when needed, since the import slows down the startup
+  import zipfile
+
+  zip_file = zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=1, allowZip64=True)
 
   # this is for name collision check, since ZipFile class does not
   # warn about the collisions and it rather overrides the current content
   written_set = set()
 
+  # the number of times each original name has been used, so that the next
+  # number for a colliding name is known without trying all of the previous
+  # numbers one by one
+  name_counter = Counter()
+
   for file in files:
     orig_file_name = os.path.basename(file)
     no_collision_name = orig_file_name
 
-    counter = 0
-
     while no_collision_name in written_set:
-      counter += 1
+      name_counter[orig_file_name] += 1
 
       # example: (13) myfile
-      no_collision_name = '({}) {}'.format(counter, no_collision_name)
+      no_collision_name = '({}) {}'.format(name_counter[orig_file_name],
+                                           orig_file_name)
 
-    zip_file.write(file, no_collision_name)
+    if is_compressed(file):
+      compress_type = zipfile.ZIP_STORED
+    else:
+      compress_type = zipfile.ZIP_DEFLATED
+
+    zip_file.write(file, no_collision_name, compress_type=compress_type)
     written_set.add(no_collision_name)
 
   zip_file.close()
@@ -611,8 +1482,11 @@ def zip_files(files, zip_path):
 def main():
   """The actual entry point of the program.
 
+  The error messages are written to the standard error, and the program
+  stops at the first error.
+
   Returns:
-    None.
+    int: The exit status, 0 on success and 1 on failure.
   """
 
   ERR_MSG_ILLEGAL_OPT = 'Illegal or conflicting command line option(s) was specified.'
@@ -623,9 +1497,9 @@ def main():
 
   parsed = parse_args(sys.argv)
 
-  if parsed == False:
-    print(ERR_MSG_ILLEGAL_OPT)
-    return
+  if parsed is None:
+    sys.stderr.write(ERR_MSG_ILLEGAL_OPT + '\n')
+    return 1
 
   (selectors, operations, output_modes, paths) = parsed
 
@@ -633,23 +1507,23 @@ def main():
   if not (resolve_datetime_selectors(selectors) and
           resolve_size_selectors(selectors) and
           resolve_match_selector(selectors)):
-    print(ERR_MSG_ILLEGAL_ARG)
-    return
+    sys.stderr.write(ERR_MSG_ILLEGAL_ARG + '\n')
+    return 1
 
   # verify the traversal roots
   if not resolve_paths(paths):
-    print(ERR_MSG_PATH_NOT_DIR)
-    print(', '.join('"' + s + '"' for s in paths))
-    return
+    sys.stderr.write(ERR_MSG_PATH_NOT_DIR + '\n' +
+                     ', '.join('"' + s + '"' for s in paths) + '\n')
+    return 1
 
-  visit_table = {}
+  visited_dirs = set()
   stats = {
     'visit_count': 0,
     'list_count': 0,
     'visit_size': 0,
     'list_size': 0
   }
-  selected = set()
+  selected = {}
 
   if output_modes[CMD_OPT_DUPLCONT] or output_modes[CMD_OPT_DUPLNAME]:
     # actually duplcont and/or duplname means there WILL be output, but we have
@@ -657,30 +1531,36 @@ def main():
     # are tricking traverse to silence it
     output_modes[CMD_OPT_NOFILELIST] = True
 
-  for path in paths:
-    try:
-      traverse(path, visit_table, selected, stats, selectors, output_modes)
-    except Exception as e:
-      print(ERR_MSG_TRAVERSE.format(e.message))
-      return
-
-  if output_modes[CMD_OPT_DUPLNAME] or output_modes[CMD_OPT_DUPLCONT]:
-    # print the duplicates in sorted order
-    print_dupl(sorted(selected) if output_modes[CMD_OPT_DUPLNAME] else selected,
-               output_modes[CMD_OPT_DUPLNAME],
-               stats)
-
-  if output_modes[CMD_OPT_STATS]:
-    print_stats(stats)
+  # the listing, the duplicates and the statistics are all written through
+  # the same buffer
+  with OutputBuffer() as out:
+    for path in paths:
+      try:
+        traverse(path, visited_dirs, selected, stats, selectors, output_modes,
+                 out)
+      except Exception as e:
+        out.flush()
+        sys.stderr.write(ERR_MSG_TRAVERSE.format(e) + '\n')
+        return 1
+
+    if output_modes[CMD_OPT_DUPLNAME] or output_modes[CMD_OPT_DUPLCONT]:
+      # print the duplicates, each bucket is sorted by print_dupl itself
+      print_dupl(selected, output_modes[CMD_OPT_DUPLNAME], stats, out)
+
+    if output_modes[CMD_OPT_STATS]:
+      print_stats(stats, out)
 
   # first zip then delete, obviously
   if operations[CMD_OPT_ZIP]:
     if not zip_files(selected, operations[CMD_OPT_ZIP]):
-      print(ERR_MSG_ZIP_FAILED)
+      sys.stderr.write(ERR_MSG_ZIP_FAILED + '\n')
+      return 1
 
   if operations[CMD_OPT_DELETE]:
     delete_files(selected)
 
+  return 0
+
 
 def safe_main_wrapper():
   """A simple wrapper around the actual entry point.
@@ -691,15 +1571,17 @@ def safe_main_wrapper():
   error/exception message of the Pyton interpreter.
 
   Returns:
-    None.
+    int: The exit status, 0 on success and 1 on failure.
   """
 
   ERR_MSG_UNC_EXC = 'An uncaught exception occured: {}'
 
   try:
-    main()
+    return main()
   except Exception as e:
-    print(ERR_MSG_UNC_EXC.format(e.message))
+    sys.stderr.write(ERR_MSG_UNC_EXC.format(e) + '\n')
+    return 1
 
 
-safe_main_wrapper()
+if __name__ == '__main__':
+  sys.exit(safe_main_wrapper())